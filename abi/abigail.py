@@ -1,7 +1,7 @@
 from enum import IntFlag
-from subprocess import run, PIPE
+from subprocess import run, Popen, PIPE
 from shutil import which
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Sequence, Union, IO
 from pathlib import Path
 from os import PathLike
 
@@ -27,13 +27,17 @@ def _which_ensure(cmd: str) -> str:
         raise RuntimeError(f"Unable to find `{cmd}` executable in PATH")
     return cmd_path
 
+def _spawn_kwargs(pass_fds: Sequence[int] = ()) -> dict:
+    # Python's own fds are non-inheritable, so unless some must be passed down
+    # there is no need for close_fds, which keeps CPython on posix_spawn
+    return {"pass_fds": pass_fds} if pass_fds else {"close_fds": False}
+
 def _split_bins_and_dirs(raw_bins: List[Path]) -> Tuple[str, List[str]]:
     bin_files = []
-    bin_dirs = set()
-    if len(raw_bins) > 0:
-        for p in raw_bins:
-            bin_files.append(p.name)
-            bin_dirs.add(str(p.parent))
+    bin_dirs = {} # a dict rather than a set, so dirs keep a stable order
+    for p in raw_bins:
+        bin_files.append(p.name)
+        bin_dirs[str(p.parent)] = None
     bin_files_arg = ",".join(bin_files)    
     return (bin_files_arg, list(bin_dirs))
     
@@ -44,9 +48,15 @@ def abidiff(
         bins2: List[Path],
         suppression_file: Optional[Path] = None,
         show_cmd: bool = False,
-        extra_args: List[str] = [] # makes it easy to add extra while prototyping
-        
+        extra_args: List[str] = [], # makes it easy to add extra while prototyping
+        pass_fds: Sequence[int] = (),
+        stdout_file: Optional[Union[IO[bytes], int]] = None
 ):
+    """
+    Runs `abidiff`. Its report is captured as text in the `stdout` of the
+    result, unless `stdout_file` (a binary file or e.g. `subprocess.DEVNULL`)
+    is given, in which case it is written there instead.
+    """
     cmd = _which_ensure("abidiff")
     bin1 = bins1[0]
     bin2 = bins2[0]
@@ -69,16 +79,17 @@ def abidiff(
     args.append(str(bin2.absolute()))
     if show_cmd:
         print_cmd(args)
-    return run(args, stdout=PIPE, stderr=PIPE, text=True), args
+    stdout = PIPE if stdout_file is None else stdout_file
+    return run(args, stdout=stdout, stderr=PIPE, text=True, **_spawn_kwargs(pass_fds)), args
     
     
 
-def abidw(
+def _abidw_args(
         bins: List[Path],
         suppression_file: Optional[Path] = None,
         show_cmd: bool = False,
-        extra_args : List[str] = [], 
-):
+        extra_args : List[str] = [],
+) -> List[str]:
     binary, *added_bins = bins
     added_bins_arg, added_dirs = _split_bins_and_dirs(added_bins)
     cmd = _which_ensure("abidw")
@@ -93,4 +104,27 @@ def abidw(
     args.append(str(binary))
     if show_cmd:
         print_cmd(args)
-    return run(args, stdout=PIPE, stderr=PIPE, text=True)
+    return args
+
+def abidw(
+        bins: List[Path],
+        suppression_file: Optional[Path] = None,
+        show_cmd: bool = False,
+        extra_args : List[str] = [], 
+):
+    args = _abidw_args(bins, suppression_file, show_cmd, extra_args)
+    return run(args, stdout=PIPE, stderr=PIPE, text=True, **_spawn_kwargs())
+
+def abidw_popen(
+        bins: List[Path],
+        suppression_file: Optional[Path] = None,
+        show_cmd: bool = False,
+        extra_args : List[str] = [],
+) -> Popen:
+    '''
+    Like `abidw`, but returns the running process so its (binary) stdout can be
+    consumed incrementally. The caller is responsible for draining stderr and
+    waiting on the process.
+    '''
+    args = _abidw_args(bins, suppression_file, show_cmd, extra_args)
+    return Popen(args, stdout=PIPE, stderr=PIPE, **_spawn_kwargs())
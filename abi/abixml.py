@@ -1,38 +1,146 @@
 from argparse import ArgumentParser
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-import xml.etree.ElementTree as ET
+from io import BytesIO
+import sys
+import re
+from xml.sax.saxutils import unescape
+try:
+    from lxml import etree as ET
+    _HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _HAVE_LXML = False
 from subprocess import run, PIPE
+from threading import Thread
 from shutil import which
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from typing import Self, List, Union, Tuple, Optional
+from typing import Self, List, Union, Tuple, Optional, IO, Iterator, Callable, TypeVar, Set
 from pprint import pformat
 from spack.cmd import parse_specs, require_active_env
 from spack.cmd.common import arguments
 try:
-    from spack.extensions.abi.abigail import abidw
+    from spack.extensions.abi.abigail import abidw, abidw_popen
     from spack.extensions.abi.common import AbiSubcommand, find_matching_specs, libs_for_spec
 except:
     from abi.common import AbiSubcommand, find_matching_specs, libs_for_spec
-    from abi.abigail import abidw
+    from abi.abigail import abidw, abidw_popen
+
+# abidw writes one element per line, indented by two spaces per level
+_ABI_INSTR_INDENT = re.compile(rb"^( *)<abi-instr\b", re.M)
+_XML_ENTITIES = {"&apos;": "'", "&quot;": '"'}
+
+def _child_elements(parent: ET.Element, tag: str) -> Iterator[ET.Element]:
+    if _HAVE_LXML: # a C-level child scan, without going through lxml's ElementPath
+        return parent.iterchildren(tag)
+    return parent.iterfind(tag)
+
+# Elements whose children make up the corpus, see `_iter_corpus_children`
+_CORPUS_CONTAINERS = ("elf-function-symbols", "elf-variable-symbols", "abi-instr")
 
-def _get_or_fail(xelt: ET.Element, attr: str) -> str:
-    output = xelt.get(attr)
-    if output is None:
-        raise AttributeError(attr, xelt.keys())
-    return output
+def _release(xelt: ET.Element):
+    xelt.clear()
+    if _HAVE_LXML: # drop the already consumed siblings from the partial tree
+        while xelt.getprevious() is not None:
+            del xelt.getparent()[0]
+
+def _iter_corpus_children(
+        source: IO[bytes],
+        root_out: List[ET.Element],
+        containers_out: Set[str]
+) -> Iterator[Tuple[str, ET.Element]]:
+    '''
+    Incrementally parse ABIXML from `source`, yielding (container tag, child)
+    for each child of the symbol tables and `abi-instr`s. Consumed elements are
+    released as parsing proceeds, so the whole document is never held in
+    memory. The tag of every container found, including empty ones, is added to
+    `containers_out`, and the root element is appended to `root_out` once
+    parsing is complete.
+    '''
+    if _HAVE_LXML:
+        # lxml filters on the C side, so only the containers reach Python and
+        # each is released once its children are consumed
+        events = ET.iterparse(source, events=("end",), tag=_CORPUS_CONTAINERS)
+        for _, xelt in events:
+            containers_out.add(xelt.tag)
+            for child in xelt:
+                yield xelt.tag, child
+            _release(xelt)
+    else:
+        # The stdlib reports every element, so hand out each child as soon as it
+        # is complete and drop it from its container, rather than building the
+        # whole container first
+        events = ET.iterparse(source, events=("start", "end"))
+        depth = 0
+        container = None
+        container_depth = 0
+        for event, xelt in events:
+            if event == "start":
+                depth += 1
+                if container is None and xelt.tag in _CORPUS_CONTAINERS:
+                    containers_out.add(xelt.tag)
+                    container = xelt
+                    container_depth = depth
+                continue
+            if container is not None:
+                if depth == container_depth + 1:
+                    yield container.tag, xelt
+                    # may also drop siblings that are still being parsed,
+                    # which is fine since their events hold a reference
+                    del container[:]
+                elif depth == container_depth:
+                    _release(container)
+                    container = None
+            depth -= 1
+    root_out.append(events.root)
 
-def _find_or_fail(xelt: ET.Element, node: str) -> ET.Element:
-    output = xelt.find(node)
-    if output is None:
-        raise AttributeError(node, xelt)
-    return output
+T = TypeVar("T")
+
+def _parse_abidw_stream(
+        parse: Callable[[IO[bytes]], T],
+        bins: List[Path],
+        suppression_file: Optional[Path] = None,
+        show_cmd: bool = False,
+        extra_args: List[str] = []
+) -> T:
+    '''
+    Run `abidw` on `bins`, handing its stdout to `parse` as it is produced
+    '''
+    proc = abidw_popen(
+        bins,
+        suppression_file=suppression_file,
+        show_cmd=show_cmd,
+        extra_args=extra_args
+    )
+    stdout, stderr = proc.stdout, proc.stderr
+    assert stdout is not None and stderr is not None
+    stderr_chunks: List[bytes] = []
+    # abidw blocks if its stderr pipe fills up while we are reading stdout
+    stderr_reader = Thread(target=lambda: stderr_chunks.append(stderr.read()))
+    stderr_reader.start()
+    try:
+        parsed = parse(stdout)
+    except Exception:
+        # Let abidw finish so that its own failure is reported instead of
+        # the parse error from the truncated output it left behind
+        stdout.read()
+        if proc.wait() == 0:
+            raise
+    finally:
+        stdout.close()
+        stderr_reader.join()
+    if proc.wait() != 0:
+        stderr_txt = b"".join(stderr_chunks).decode("utf8", errors="replace")
+        raise RuntimeError(f"abidw failed with the following stderr:\n{stderr_txt}")
+    return parsed
 
 class ABIXML(ABC):
     '''
     The root visitor for all ABIXML elts. `from_xmlelt` is the visiting function
     '''
+    __slots__ = ()
+
     @staticmethod
     @abstractmethod 
     def abixml_tag() -> str: ...
@@ -43,14 +151,29 @@ class ABIXML(ABC):
 
     @classmethod
     def as_children(cls, parent: Optional[ET.Element]) -> List[Self]:
-        if parent:
-            return [cls.from_xmlelt(x) for x in parent.findall(cls.abixml_tag())]
+        if parent is not None:
+            return [cls.from_xmlelt(x) for x in _child_elements(parent, cls.abixml_tag())]
         else:
             return []
 
-    def to_supression(self, file: Path) -> str: ...
+    def to_suppression(self, file: str) -> str:
+        raise NotImplementedError(f"No suppression for {self.abixml_tag()}")
 
-@dataclass
+class _FileDecl(ABIXML):
+    '''
+    Base for decls with a `filepath`, which is stored as the raw (interned)
+    string from the ABIXML since most consumers never look at it
+    '''
+    __slots__ = ()
+    filepath: Optional[str]
+
+    @property
+    def filepath_path(self) -> Optional[Path]:
+        return Path(self.filepath) if self.filepath is not None else None
+
+# Enumerated attributes (type, binding, visibility, access) only take a handful
+# of distinct values, so they are interned rather than stored once per element
+@dataclass(slots=True)
 class Symbol(ABIXML):
     name: str
     size: int
@@ -65,39 +188,38 @@ class Symbol(ABIXML):
         
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
+        a = xelt.attrib
         return cls(
-            name=_get_or_fail(xelt, "name"),
-            size=int(xelt.get('size', 0)),
-            typ=_get_or_fail(xelt, "type"),
-            binding=_get_or_fail(xelt, "binding"),
-            visibility=_get_or_fail(xelt, "visibility"),
-            defined=_get_or_fail(xelt, "is-defined") == 'yes'
+            name=a["name"],
+            size=int(a.get("size", 0)),
+            typ=sys.intern(a["type"]),
+            binding=sys.intern(a["binding"]),
+            visibility=sys.intern(a["visibility"]),
+            defined=a["is-defined"] == 'yes'
         )
 
-@dataclass
-class VarDecl(ABIXML):
+@dataclass(slots=True)
+class VarDecl(_FileDecl):
     name: str
     type_id: str
     visibility: str
-    filepath: Optional[Path]
+    filepath: Optional[str]
 
     @staticmethod
     def abixml_tag() -> str:
         return "var-decl"
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
-        if xelt.get('filepath') is not None:
-            filepath = Path(xelt.get('filepath'))
-        else:
-            filepath = None
+        a = xelt.attrib
+        opt_path = a.get("filepath")
         return cls(
-            name=_get_or_fail(xelt, "name"),
-            type_id=_get_or_fail(xelt, "type-id"),
-            visibility=_get_or_fail(xelt, "visibility"),
-            filepath=filepath
+            name=a["name"],
+            type_id=a["type-id"],
+            visibility=sys.intern(a["visibility"]),
+            filepath=sys.intern(opt_path) if opt_path is not None else None
         )
     
-@dataclass
+@dataclass(slots=True)
 class TypeDecl(ABIXML):
     name: str
     size: Optional[int]
@@ -110,18 +232,16 @@ class TypeDecl(ABIXML):
         
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
-        if xelt.get("size-in-bits") is not None:
-            size = int(xelt.get("size-in-bits"))
-        else:
-            size = None
+        a = xelt.attrib
+        opt_size = a.get("size-in-bits")
         return cls(
-            name=_get_or_fail(xelt, "name"),
-            size=size,
-            hash=xelt.get("hash"),
-            id=_get_or_fail(xelt, "id")
+            name=a["name"],
+            size=int(opt_size) if opt_size is not None else None,
+            hash=a.get("hash"),
+            id=a["id"]
         )
     
-@dataclass    
+@dataclass(slots=True)
 class Parameter(ABIXML):
     type_id: Optional[str]
     name: Optional[str]
@@ -132,17 +252,18 @@ class Parameter(ABIXML):
         return "parameter"
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
+        a = xelt.attrib
         return cls(
-            type_id=xelt.get("type-id"),
-            name=xelt.get("name"),
-            is_variadic=xelt.get("is_variadic") == "yes"
+            type_id=a.get("type-id"),
+            name=a.get("name"),
+            is_variadic=a.get("is_variadic") == "yes"
         )
 
-@dataclass    
-class FunctionDecl(ABIXML):
+@dataclass(slots=True)
+class FunctionDecl(_FileDecl):
     name: str
     mangled_name: Optional[str]
-    filepath: Optional[Path]
+    filepath: Optional[str]
     parameters: List[Parameter]
     return_type_id: str
     
@@ -153,27 +274,31 @@ class FunctionDecl(ABIXML):
     
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
-        if xelt.get('filepath') is not None:
-            filepath = Path(xelt.get('filepath'))
-        else:
-            filepath = None
+        a = xelt.attrib
+        opt_path = a.get("filepath")
+        # parameters and the return type are collected in one walk of the children
+        parameters = []
+        return_type_id = None
+        for child in xelt:
+            if child.tag == Parameter.abixml_tag():
+                parameters.append(Parameter.from_xmlelt(child))
+            elif child.tag == "return":
+                return_type_id = child.attrib["type-id"]
+        if return_type_id is None:
+            raise AttributeError("return", xelt)
         return cls(
-            name=_get_or_fail(xelt, "name"),
-            mangled_name=xelt.get("mangled-name"),
-            filepath=filepath,
-            parameters=Parameter.as_children(xelt),
-            return_type_id=_get_or_fail(_find_or_fail(xelt, "return"), "type-id")
+            name=a["name"],
+            mangled_name=a.get("mangled-name"),
+            filepath=sys.intern(opt_path) if opt_path is not None else None,
+            parameters=parameters,
+            return_type_id=return_type_id
         )
-    def to_suppression(self, file: Path) -> str:
-        output_lines = [
-            "[suppress_function]",
-            f"name = {self.name}",
-            # f"file_name_regexp = {regex_for_filename(file)}"
-        ]
-        return "\n  ".join(output_lines)
+    def to_suppression(self, file: str) -> str:
+        # + f"\n  file_name_regexp = {regex_for_filename(file)}"
+        return f"[suppress_function]\n  name = {self.name}"
     
 
-@dataclass
+@dataclass(slots=True)
 class DataMember(ABIXML):
     access: str
     layout_offset: int
@@ -185,25 +310,30 @@ class DataMember(ABIXML):
     
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
-        decl_xml = xelt.find(VarDecl.abixml_tag())
-        if decl_xml is None: # if it is not VarDecl, it must be a function decl
-            decl_xml = _find_or_fail(xelt, FunctionDecl.abixml_tag())
-            decl = FunctionDecl.from_xmlelt(decl_xml)
-        else:
-            decl = VarDecl.from_xmlelt(decl_xml)
+        decl: Optional[Union[FunctionDecl, VarDecl]] = None
+        for child in xelt: # the decl is a VarDecl or, failing that, a function decl
+            if child.tag == VarDecl.abixml_tag():
+                decl = VarDecl.from_xmlelt(child)
+                break
+            elif child.tag == FunctionDecl.abixml_tag():
+                decl = FunctionDecl.from_xmlelt(child)
+                break
+        if decl is None:
+            raise AttributeError(FunctionDecl.abixml_tag(), xelt)
+        a = xelt.attrib
         return cls(
-            access=_get_or_fail(xelt, "access"),
-            layout_offset=int(_get_or_fail(xelt, "layout-offset-in-bits")),
+            access=sys.intern(a["access"]),
+            layout_offset=int(a["layout-offset-in-bits"]),
             decl=decl
         )
 
-@dataclass
-class ClassDecl(ABIXML):
+@dataclass(slots=True)
+class ClassDecl(_FileDecl):
     name: str
     is_struct: bool
     visibility: str
     size: Optional[int] 
-    filepath: Optional[Path]
+    filepath: Optional[str]
     hash: Optional[str]
     id: str
     data_members: List[DataMember]
@@ -214,41 +344,38 @@ class ClassDecl(ABIXML):
     
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
-        opt_size = xelt.get("size-in-bits")
-        opt_path = xelt.get('filepath')
+        a = xelt.attrib
+        opt_size = a.get("size-in-bits")
+        opt_path = a.get("filepath")
         if opt_size:
             size = int(opt_size)
         else:
             size = None
         if opt_path:
-            filepath = Path(opt_path)
+            filepath = sys.intern(opt_path)
         else:
             filepath = None
         return cls(
-            name = _get_or_fail(xelt, "name"),
-            is_struct = _get_or_fail(xelt, "is-struct") == 'yes',
-            visibility = _get_or_fail(xelt, "visibility"),
+            name = a["name"],
+            is_struct = a["is-struct"] == 'yes',
+            visibility = sys.intern(a["visibility"]),
             size = size,
             filepath = filepath,
-            hash = xelt.get("hash"),
-            id = _get_or_fail(xelt, "id"),
+            hash = a.get("hash"),
+            id = a["id"],
             data_members = DataMember.as_children(xelt)
         )
 
-    def to_suppression(self, file: Path) -> str:
-        output_lines = [
-            "[suppress_type]",
-            f"name = {self.name}",
-            # f"file_name_regexp = {regex_for_filename(file)}"
-        ]
-        return "\n  ".join(output_lines)
+    def to_suppression(self, file: str) -> str:
+        # + f"\n  file_name_regexp = {regex_for_filename(file)}"
+        return f"[suppress_type]\n  name = {self.name}"
 
-@dataclass
-class TypedefDecl(ABIXML):
+@dataclass(slots=True)
+class TypedefDecl(_FileDecl):
     name: str
     member_id: str
     type_id: str
-    filepath: Path
+    filepath: Optional[str] # always present for typedefs
 
     @staticmethod
     def abixml_tag() -> str:
@@ -256,20 +383,17 @@ class TypedefDecl(ABIXML):
 
     @classmethod
     def from_xmlelt(cls, xelt: ET.Element) -> Self:
+        a = xelt.attrib
         return cls(
-            name = _get_or_fail(xelt, "name"),
-            member_id = _get_or_fail(xelt, "type-id"),
-            type_id = _get_or_fail(xelt, "id"),
-            filepath = Path(_get_or_fail(xelt, "filepath"))
+            name = a["name"],
+            member_id = a["type-id"],
+            type_id = a["id"],
+            filepath = sys.intern(a["filepath"])
         )
 
-    def to_suppression(self, file: Path) -> str:
-        output_lines = [
-            "[suppress_type]",
-            f"name = {self.name}",
-            #f"file_name_regexp = {regex_for_filename(file)}"
-        ]
-        return "\n  ".join(output_lines)
+    def to_suppression(self, file: str) -> str:
+        # + f"\n  file_name_regexp = {regex_for_filename(file)}"
+        return f"[suppress_type]\n  name = {self.name}"
         
 
 @dataclass
@@ -277,7 +401,7 @@ class ABI:
     '''
     General structure of ABI-corpus
     '''
-    path: Path
+    path: str
     fun_symbols : List[Symbol]
     var_symbols : List[Symbol]
     type_decls : List[TypeDecl]
@@ -292,8 +416,13 @@ class ABI:
             bins: List[Path],
             suppression_file: Optional[Path] = None,
             show_cmd: bool = False,
-            extra_args: List[str] = []
-    ) -> Tuple[Self, str]:
+            extra_args: List[str] = [],
+            parse: bool = True
+    ) -> Tuple[Optional[Self], str]:
+        '''
+        Runs `abidw` and returns its ABIXML alongside the parsed ABI, or `None`
+        in place of the latter if `parse` is false
+        '''
         result = abidw(
             bins,
             suppression_file=suppression_file,
@@ -303,27 +432,71 @@ class ABI:
         if result.returncode != 0:
             raise RuntimeError(f"abidw failed with the following stderr:\n{result.stderr}")
         xml_str = result.stdout
-        return (cls.from_xml(xml_str), xml_str)
+        return (cls.from_xml(xml_str) if parse else None, xml_str)
+
+    @classmethod
+    def from_binaries_stream(
+            cls,
+            bins: List[Path],
+            suppression_file: Optional[Path] = None,
+            show_cmd: bool = False,
+            extra_args: List[str] = []
+    ) -> Self:
+        '''
+        Parse the ABI while `abidw` is still writing it, without ever holding
+        the XML text in memory. Use `from_binaries` when the text is needed.
+        '''
+        return _parse_abidw_stream(
+            cls.from_xml_stream,
+            bins,
+            suppression_file=suppression_file,
+            show_cmd=show_cmd,
+            extra_args=extra_args
+        )
 
     @classmethod
     def from_xml(cls, xml_str: str) -> Self:
-        root = ET.fromstring(xml_str)
-        path = Path(_get_or_fail(root, "path"))
+        return cls.from_xml_stream(BytesIO(xml_str.encode("utf8")))
+
+    @classmethod
+    def from_xml_stream(cls, source: IO[bytes]) -> Self:
         type_decls = []
         class_decls = []
         fun_decls = []
         typedef_decls = []
         var_decls = []
-        fun_symbols = Symbol.as_children(_find_or_fail(root, 'elf-function-symbols'))
-        var_symbols = Symbol.as_children(root.find('elf-variable-symbols'))
-        for decls_root in root.findall("abi-instr"):
-            type_decls.extend(TypeDecl.as_children(decls_root))
-            class_decls.extend(ClassDecl.as_children(decls_root))
-            fun_decls += FunctionDecl.as_children(decls_root)
-            typedef_decls.extend(TypedefDecl.as_children(decls_root))
-            var_decls.extend(VarDecl.as_children(decls_root))
+        fun_symbols = []
+        var_symbols = []
+        root_out: List[ET.Element] = []
+        containers: Set[str] = set()
+        try:
+            for container, xelt in _iter_corpus_children(source, root_out, containers):
+                tag = xelt.tag
+                if container == "elf-function-symbols":
+                    if tag == Symbol.abixml_tag():
+                        fun_symbols.append(Symbol.from_xmlelt(xelt))
+                elif container == "elf-variable-symbols":
+                    if tag == Symbol.abixml_tag():
+                        var_symbols.append(Symbol.from_xmlelt(xelt))
+                elif tag == TypeDecl.abixml_tag():
+                    type_decls.append(TypeDecl.from_xmlelt(xelt))
+                elif tag == ClassDecl.abixml_tag():
+                    class_decls.append(ClassDecl.from_xmlelt(xelt))
+                elif tag == FunctionDecl.abixml_tag():
+                    fun_decls.append(FunctionDecl.from_xmlelt(xelt))
+                elif tag == TypedefDecl.abixml_tag():
+                    typedef_decls.append(TypedefDecl.from_xmlelt(xelt))
+                elif tag == VarDecl.abixml_tag():
+                    var_decls.append(VarDecl.from_xmlelt(xelt))
+        except KeyError as e: # required attribute missing from `xelt` or a child
+            raise AttributeError(e.args[0], xelt.tag) from e
+        root = root_out[0]
+        if "elf-function-symbols" not in containers:
+            raise AttributeError('elf-function-symbols', root)
+        if root.get("path") is None:
+            raise AttributeError("path", root.keys())
         return cls(
-            path = path,
+            path = root.get("path"),
             fun_symbols = fun_symbols,
             var_symbols = var_symbols,
             class_decls = class_decls,
@@ -332,6 +505,29 @@ class ABI:
             typedef_decls = typedef_decls,
             var_decls = var_decls
         )
+
+    @staticmethod
+    def names_from_xml_fast(xml_bytes: bytes) -> Tuple[List[str], List[str]]:
+        '''
+        Computes `type_and_function_names` by scanning the text of `abidw`'s
+        output for the `name` of the elements directly inside an `abi-instr`,
+        without building a tree or any IR.
+        '''
+        instr = _ABI_INSTR_INDENT.search(xml_bytes)
+        if instr is None:
+            return [], []
+        decl_indent = instr.group(1) + b"  "
+        def names(tag: bytes) -> List[str]:
+            pattern = re.compile(
+                rb"^" + decl_indent + rb"<" + tag + rb"(?=\s)[^>]*?\sname=(['\"])(.*?)\1",
+                re.M
+            )
+            return [
+                unescape(m.group(2).decode("utf8"), _XML_ENTITIES)
+                for m in pattern.finditer(xml_bytes)
+            ]
+        return names(b"class-decl") + names(b"typedef-decl"), names(b"function-decl")
+
     def type_and_function_names(self) -> Tuple[List[str], List[str]]:
         type_names = [cd.name for cd in self.class_decls] + [td.name for td in self.typedef_decls]
         func_names = [fd.name for fd in self.fun_decls]
@@ -371,19 +567,22 @@ class XmlCmd(AbiSubcommand):
         assert (len(specs) == 1), "Cannot analyze ABI for more than one spec at a time"
         spec = specs[0]
         spec_libs = libs_for_spec(spec)
-        abi_obj, xml_str = ABI.from_binaries(
-            spec_libs,
+        abidw_kwargs = dict(
             suppression_file=args.suppression_file,
             show_cmd=args.show_cmd,
             extra_args=args.extra_args
-        ) 
+        )
         if args.output_format == "xml":
-            output_text = xml_str
+            _, output_text = ABI.from_binaries(spec_libs, parse=False, **abidw_kwargs)
         elif args.output_format == "names":
-            type_names, func_names = abi_obj.type_and_function_names()
+            type_names, func_names = _parse_abidw_stream(
+                lambda stdout: ABI.names_from_xml_fast(stdout.read()),
+                spec_libs,
+                **abidw_kwargs
+            )
             output_text = "\n".join(type_names + func_names)
         else:  
-            output_text = pformat(abi_obj)
+            output_text = pformat(ABI.from_binaries_stream(spec_libs, **abidw_kwargs))
         if args.output_file:
             with open(args.output_file, "w") as f:
                 f.write(output_text)
@@ -6,7 +6,8 @@ from spack.cmd import display_specs
 import sys
 import spack.environment as ev
 import spack.store
-from typing import List, Self, Optional, Tuple, TypeVar
+from typing import List, Self, Optional, Tuple, TypeVar, Iterator
+from itertools import permutations
 from pathlib import Path
 from argparse import ArgumentParser
 
@@ -30,17 +31,12 @@ class AbiSubcommand(ABC):
 
 T = TypeVar("T")
 
-def cross_product_self(lst: List[T]) -> List[Tuple[T, T]]:
+def cross_product_self(lst: List[T]) -> Iterator[Tuple[T, T]]:
     """
-    Computes the cross product of a list with itself, skipping elements
+    Lazily computes the cross product of a list with itself, skipping elements
     which are at the same index (so as not to rely on == for equality)
     """
-    return [
-        (elt1, elt2)
-        for i, elt1 in enumerate(lst)
-        for j, elt2 in enumerate(lst)
-        if i != j
-    ]
+    return permutations(lst, 2)
 
 def _spec_to_build_interface(spec: Spec):
     if not spec.installed:
@@ -1,13 +1,15 @@
 from argparse import REMAINDER, ArgumentParser
 from pathlib import Path
+import os
 import subprocess
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 from warnings import showwarning
 ########
 from spack.cmd import require_active_env, parse_specs
 from spack.spec import Spec
 ########
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Iterator, Union, IO
 try:
     from spack.extensions.abi.common import (
         AbiSubcommand,
@@ -23,6 +25,30 @@ except: # LSP can identify symbols
     from abi.suppress import suppression_for_binaries_from_header
     from abi.abigail import abidiff, print_cmd, DiffExitCode
 
+@contextmanager
+def _suppression_file(suppression_chunks: List[bytes]) -> Iterator[Tuple[Optional[Path], Tuple[int, ...]]]:
+    """
+    Provides the concatenation of `suppression_chunks` as a file for `abidiff`,
+    along with the file descriptors the process must inherit to read it. On
+    Linux the text is kept in an anonymous in-memory file, elsewhere it goes
+    through a temporary file.
+    """
+    if len(suppression_chunks) == 0:
+        yield None, ()
+    elif hasattr(os, "memfd_create"):
+        fd = os.memfd_create("suppressions")
+        try:
+            with open(fd, "wb", closefd=False) as f:
+                f.writelines(suppression_chunks)
+            yield Path(f"/dev/fd/{fd}"), (fd,)
+        finally:
+            os.close(fd)
+    else:
+        with NamedTemporaryFile(delete_on_close=False) as tf:
+            tf.writelines(suppression_chunks)
+            tf.close()
+            yield Path(tf.name), ()
+
 def diff_specs(
         spec1: Spec,
         spec2: Spec,
@@ -32,41 +58,55 @@ def diff_specs(
         suppr2: Optional[str] = None,
         show_cmd: bool = False,
         extra_args: List[str] = [],
+        abixml1: Optional[Path] = None,
+        abixml2: Optional[Path] = None,
+        stdout_file: Optional[Union[IO[bytes], int]] = None,
+        libs1: Optional[List[Path]] = None,
+        libs2: Optional[List[Path]] = None,
 ) -> Tuple[subprocess.CompletedProcess, List[str]]:
     """
+    `abixml1`/`abixml2` are ABIXML files previously serialized from the libs of
+    `spec1`/`spec2`; when present they are compared instead of the binaries.
+    `libs1`/`libs2` are the already resolved libs of `spec1`/`spec2`, they are
+    only looked up here when a header suppression or the binaries need them.
+    `stdout_file` is passed through to `abidiff`.
     """
-    spec1_libs = libs_for_spec(spec1)
-    spec2_libs = libs_for_spec(spec2)
+    spec1_libs = libs1
+    if spec1_libs is None and (header1 or not abixml1):
+        spec1_libs = libs_for_spec(spec1)
+    spec2_libs = libs2
+    if spec2_libs is None and (header2 or not abixml2):
+        spec2_libs = libs_for_spec(spec2)
     if header1:
         spec1_header = [h for h in headers_for_spec(spec1) if h.name == header1][0]
         spec1_suppression = suppression_for_binaries_from_header(spec1_libs, spec1_header)
     elif suppr1:
-        with open(suppr1, "r") as f:
+        with open(suppr1, "rb") as f:
             spec1_suppression = f.read()
     else:
-        spec1_suppression = ""
+        spec1_suppression = b""
     if header2:
         spec2_header = [h for h in headers_for_spec(spec2) if h.name == header2][0]
         spec2_suppression = suppression_for_binaries_from_header(spec2_libs, spec2_header)
     elif suppr2:
-        with open(suppr2, "r") as f:
+        with open(suppr2, "rb") as f:
             spec2_suppression = f.read()
     else:
-        spec2_suppression = ""
-    suppression_txt = spec1_suppression + spec2_suppression
-    with NamedTemporaryFile(delete_on_close=False) as tf:
-        if len(suppression_txt) != 0:
-            tf.write(suppression_txt.encode("utf8"))
-            tf.close()
-            suppression_file = Path(tf.name)
-        else:
-            suppression_file = None
+        spec2_suppression = b""
+    # newline terminated, so the last entry of one doesn't run into the next
+    suppression_chunks = [
+        chunk for suppr in (spec1_suppression, spec2_suppression) if suppr
+        for chunk in (suppr, b"\n")
+    ]
+    with _suppression_file(suppression_chunks) as (suppression_file, pass_fds):
         result, args = abidiff(
-            spec1_libs,
-            spec2_libs,
+            [abixml1] if abixml1 else spec1_libs,
+            [abixml2] if abixml2 else spec2_libs,
             suppression_file=suppression_file,
             show_cmd=show_cmd,
-            extra_args=extra_args
+            extra_args=extra_args,
+            pass_fds=pass_fds,
+            stdout_file=stdout_file
         )
         return result, args
 
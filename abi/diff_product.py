@@ -1,20 +1,27 @@
 try:
-    from spack.extensions.abi.abigail import DiffExitCode, print_cmd
-    from spack.extensions.abi.common import AbiSubcommand, cross_product_self
+    from spack.extensions.abi.abigail import DiffExitCode, print_cmd, abidw
+    from spack.extensions.abi.common import AbiSubcommand, cross_product_self, libs_for_spec
     from spack.extensions.abi.diff import diff_specs
 except:
-    from abi.abigail import DiffExitCode, print_cmd
-    from abi.common import AbiSubcommand, cross_product_self
+    from abi.abigail import DiffExitCode, print_cmd, abidw
+    from abi.common import AbiSubcommand, cross_product_self, libs_for_spec
     from abi.diff import diff_specs
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from pathlib import Path
 from enum import Enum, auto
+from concurrent.futures import Future, ThreadPoolExecutor
+from tempfile import NamedTemporaryFile, TemporaryDirectory, TemporaryFile
+from io import TextIOWrapper
+from shutil import copyfileobj
+from subprocess import CompletedProcess, DEVNULL
+import os
 
 
 from spack.environment import Environment
+from spack.spec import Spec
 
 import sys
-from typing import TypeVar, List, Tuple
+from typing import TypeVar, List, Tuple, Optional, IO, Dict
 T = TypeVar('T')
 
 class AbiDiffType(Enum):
@@ -34,7 +41,63 @@ def return_code_to_diff_type(rc: int) -> AbiDiffType:
     else: # There was a usage error
         return AbiDiffType.ERROR
 
-   
+
+LibStats = Tuple[Tuple[str, int, int], ...]
+
+def _lib_stats(libs: List[Path]) -> LibStats:
+    stats = []
+    for lib in libs:
+        st = lib.stat()
+        stats.append((str(lib), st.st_mtime_ns, st.st_size))
+    return tuple(stats)
+
+def _abixml_for_libs(libs: List[Path], abixml_dir: str) -> Tuple[Path, CompletedProcess]:
+    """
+    Serialize the ABI of a set of libs to an ABIXML file in `abixml_dir`, so
+    that every comparison involving them can skip re-reading the binaries. The
+    file is only usable when `abidw` succeeded
+    """
+    with NamedTemporaryFile(dir=abixml_dir, suffix=".abi", delete=False) as tf:
+        abixml = Path(tf.name)
+    result = abidw(libs, extra_args=["--out-file", str(abixml)])
+    return abixml, result
+
+def _diff_roots(
+        spec1: Spec,
+        spec2: Spec,
+        abixml1: Optional[Path],
+        abixml2: Optional[Path],
+        libs1: List[Path],
+        libs2: List[Path],
+        keep_report: bool
+) -> Tuple[CompletedProcess, List[str], Optional[IO[bytes]]]:
+    """
+    Runs `abidiff` on two roots. Its report is written to a temporary file
+    (returned for the caller to consume and close) when `keep_report` is set,
+    and discarded otherwise, so that no report is buffered in memory
+    """
+    report = TemporaryFile() if keep_report else None
+    result, abidiff_args = diff_specs(
+        spec1,
+        spec2,
+        abixml1=abixml1,
+        abixml2=abixml2,
+        stdout_file=report if report is not None else DEVNULL,
+        libs1=libs1,
+        libs2=libs2
+    )
+    return result, abidiff_args, report
+
+
+def _positive_int(arg: str) -> int:
+    try:
+        n = int(arg)
+    except ValueError:
+        raise ArgumentTypeError(f"expected an integer, got {arg!r}")
+    if n < 1:
+        raise ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
 
 class DiffProductCmd(AbiSubcommand):
     @classmethod
@@ -55,6 +118,12 @@ class DiffProductCmd(AbiSubcommand):
             type=str,
             help="File for generated output, defaults to stdout"
         )
+        subparser.add_argument(
+            "-j", "--jobs",
+            type=_positive_int,
+            default=os.cpu_count(),
+            help="Number of `abidiff` processes to run concurrently (default: number of CPUs)"
+        )
 
     @classmethod
     def description(cls) -> str:
@@ -71,29 +140,63 @@ class DiffProductCmd(AbiSubcommand):
             env.concretize()
             env.install_all()
             env.write()
-        comparisons = cross_product_self(list(env.concretized_specs()))
+        roots = list(env.concretized_specs())
+        # resolved once per root here, spack's spec queries aren't meant to be
+        # run from the worker threads
+        roots_libs = [libs_for_spec(c) for _, c in roots]
         if args.output_file:
             outfile = open(args.output_file, "w")
         else:
             outfile = sys.stdout
-        for (u1, c1), (u2, c2) in comparisons:
-            result, abidiff_args = diff_specs(c1, c2)
-            diff_type = return_code_to_diff_type(result.returncode)
-            if args.output_format == "can_splice":
-                match diff_type:
-                    case AbiDiffType.NONE | AbiDiffType.HARMLESS:
-                        print(f"can_splice(\"{u1}\", when=\"{u2}\") #{diff_type}", file=outfile)
-                    case AbiDiffType.HARMFUL:
-                        print(f"# No splice {u1} and {u2}")
-                        continue
-                    case AbiDiffType.ERROR:
-                        print(f"abidiff reported a usage error when comparing {u1} and {u2}")
-                        print_cmd(abidiff_args)
-            elif args.output_format == "summary":
-                pass
-            else: # raw
-                print(f"Comparing {u1},{c1} to {u2},{c2}", file=outfile)
-                print(result.stdout, file=outfile)
-                print(result.stderr)
+        # abidiff does the heavy lifting in its own process, so threads are
+        # enough to keep `--jobs` of them busy
+        with TemporaryDirectory() as abixml_dir, \
+             ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            # keyed on the libs' stats, so roots sharing libs serialize them once
+            abixml_futures: Dict[LibStats, Future] = {}
+            roots_stats = [_lib_stats(libs) for libs in roots_libs]
+            for stats, libs in zip(roots_stats, roots_libs):
+                if stats not in abixml_futures:
+                    abixml_futures[stats] = executor.submit(_abixml_for_libs, libs, abixml_dir)
+            abixmls: List[Optional[Path]] = []
+            for (u, _), stats in zip(roots, roots_stats):
+                abixml, abidw_result = abixml_futures[stats].result()
+                if abidw_result.returncode != 0:
+                    print(f"abidw failed on {u}, comparing its binaries instead")
+                    print(f"STDERR: {abidw_result.stderr}")
+                    abixml = None
+                abixmls.append(abixml)
+            comparisons = cross_product_self(
+                [(u, c, x, l) for (u, c), x, l in zip(roots, abixmls, roots_libs)]
+            )
+            keep_report = args.output_format == "raw"
+            futures = [
+                (executor.submit(_diff_roots, c1, c2, x1, x2, l1, l2, keep_report), (u1, c1), (u2, c2))
+                for (u1, c1, x1, l1), (u2, c2, x2, l2) in comparisons
+            ]
+            # reported in submission order rather than as they finish, so the
+            # output doesn't depend on how the jobs were scheduled
+            for future, (u1, c1), (u2, c2) in futures:
+                result, abidiff_args, report = future.result()
+                diff_type = return_code_to_diff_type(result.returncode)
+                if args.output_format == "can_splice":
+                    match diff_type:
+                        case AbiDiffType.NONE | AbiDiffType.HARMLESS:
+                            print(f"can_splice(\"{u1}\", when=\"{u2}\") #{diff_type}", file=outfile)
+                        case AbiDiffType.HARMFUL:
+                            print(f"# No splice {u1} and {u2}")
+                            continue
+                        case AbiDiffType.ERROR:
+                            print(f"abidiff reported a usage error when comparing {u1} and {u2}")
+                            print_cmd(abidiff_args)
+                elif args.output_format == "summary":
+                    pass
+                else: # raw
+                    print(f"Comparing {u1},{c1} to {u2},{c2}", file=outfile)
+                    report.seek(0)
+                    with TextIOWrapper(report, encoding="utf8", errors="replace") as report_txt:
+                        copyfileobj(report_txt, outfile)
+                    print(file=outfile)
+                    print(result.stderr)
         if outfile != sys.stdout:
             outfile.close()
@@ -1,24 +1,47 @@
 from pathlib import Path
-from subprocess import run, PIPE
-from enum import Enum, auto
+from subprocess import Popen, PIPE
+from enum import Enum, IntFlag, auto
 from dataclasses import dataclass
-from typing import List, Tuple, Generator
-from tree_sitter import Language, Parser, Node
+from typing import List, Tuple, Generator, Optional, Iterable, Iterator, Dict
+from shutil import which, rmtree
+from tempfile import NamedTemporaryFile, TemporaryFile
+from threading import local
+import hashlib
+import os
+import pickle
+import re
+import sys
+from tree_sitter import Language, Parser, Query, QueryCursor, Tree, Node
 import tree_sitter_c as tsc
     
-def run_preproc(header_file: Path) -> str:
-    result = run(["gcc", "-E", str(header_file)], stdout=PIPE, stderr=PIPE, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"GCC preprocessor failed on {str(header_file)} with stderr:\n{result.stderr}"
-        )
-    return result.stdout
+def run_preproc(header_file: Path) -> Iterator[bytes]:
+    '''
+    Streams the lines of the preprocessed header as they are produced.
+    They are kept as bytes, which is what tree-sitter parses
+    '''
+    # stderr goes to a file, so gcc can't block on it while stdout is consumed
+    with TemporaryFile() as stderr:
+        with Popen(["gcc", "-E", str(header_file)], stdout=PIPE, stderr=stderr) as proc:
+            assert proc.stdout is not None
+            yield from iter(proc.stdout.readline, b"")
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(
+                f"GCC preprocessor failed on {str(header_file)} with stderr:\n"
+                f"{stderr.read().decode(errors='replace')}"
+            )
 
-class PreprocessorFlag(Enum):
-    NEW_FILE = 1
-    RETURNING_FILE = 2
-    SYSTEM_FILE = 3
-    EXTERN_TEXT = 4
+class PreprocessorFlag(IntFlag):
+    '''
+    Line marker flag N is bit N-1, so a marker's flags fit in a single int
+    '''
+    NEW_FILE = 1 << 0
+    RETURNING_FILE = 1 << 1
+    SYSTEM_FILE = 1 << 2
+    EXTERN_TEXT = 1 << 3
+
+# plain int, `&` with an IntFlag member would build a new flag object per test
+_SYSTEM_FILE = PreprocessorFlag.SYSTEM_FILE.value
 
 class SymbolType(Enum):
     TYPEDEF = auto()
@@ -28,114 +51,133 @@ class SymbolType(Enum):
     STRUCTDEF = auto()
     ENUMDEF = auto()
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Symbol:
     stype : SymbolType
     symbol : str
 
-    
-def _parse_type_definition(node: Node):
-    declarator = node.child_by_field_name("declarator")
-    assert declarator is not None
-    if declarator.type == "function_declarator":
-        child_declarator = declarator.child_by_field_name("declarator")
-        assert child_declarator is not None
-        assert child_declarator.type == 'parenthesized_declarator'
-        return Symbol(
-            stype = SymbolType.TYPEDEF,
-            symbol = child_declarator.text.decode("utf8")[1:-1]
-        )
-    elif declarator.type == "type_identifier":
-        return Symbol(
-            stype=SymbolType.TYPEDEF,
-            symbol = declarator.text.decode("utf8")
-        )
-    elif declarator.type == "pointer_declarator":
-        return Symbol(
-            stype = SymbolType.TYPEDEF,
-            symbol = declarator.child_by_field_name("declarator").text.decode("utf8")
-        )
-    else:
-        print(f"Unhandled declarator in _parse_type_definition: {declarator.type}")
-    return
-
-
-def _parse_declaration(node: Node):
-    declarator = node.child_by_field_name("declarator")
-    assert declarator is not None
-    if declarator.type == "function_declarator":
-        name_node = declarator.child_by_field_name("declarator") 
-        assert name_node.type == "identifier", f"Got {name_node.type}"
-        return Symbol(stype=SymbolType.FUNDEF, symbol=name_node.text.decode("utf8"))
-    elif declarator.type == "pointer_declarator":
-        name_node = declarator.child_by_field_name("declarator") 
-        return Symbol(stype=SymbolType.PTRDEF, symbol=name_node.text.decode("utf8"))
-    elif declarator.type == "identifier":
-        return Symbol(
-            stype=SymbolType.EXTERNDEF,
-            symbol=declarator.text.decode("utf8")
-        )
-    elif declarator.type == "array_declarator":
-        return Symbol(
-            stype=SymbolType.EXTERNDEF,
-            symbol=declarator.child_by_field_name("declarator").text.decode("utf8")
-        )
-    else:
-        print(f"Unhandled declarator in _parse_declaration: {declarator.type}")
-        return
 
+_C_LANGUAGE = Language(tsc.language())
 
-def _parse_struct_specifier(node: Node):
-    return Symbol(
-        stype=SymbolType.STRUCTDEF,
-        symbol=node.child_by_field_name("name").text.decode("utf8")
-    )
+# Only the direct children of the translation unit are declarations of the
+# header itself, anything deeper is e.g. a parameter or a struct member
+_DECL_QUERY = Query(_C_LANGUAGE, """
+(translation_unit (type_definition) @typedef)
+(translation_unit (declaration) @declaration)
+(translation_unit (struct_specifier name: (type_identifier) @struct))
+(translation_unit (enum_specifier name: (type_identifier) @enum))
+""")
 
-def _parse_enum_specifier(node: Node):
-    try:
-        return Symbol(
-            stype=SymbolType.ENUMDEF,
-            symbol=node.child_by_field_name("name").text.decode("utf8")
-        )
-    except:
+CAPTURE_TO_STYPE = {
+    "struct": SymbolType.STRUCTDEF,
+    "enum": SymbolType.ENUMDEF,
+}
+
+# What a declared identifier is, by the declarator directly wrapping it
+_WRAPPER_TO_STYPE = {
+    "function_declarator": SymbolType.FUNDEF,
+    "pointer_declarator": SymbolType.PTRDEF,
+}
+
+# Declarators which don't change what the identifier inside them is
+_TRANSPARENT_DECLARATORS = {"parenthesized_declarator", "attributed_declarator", "init_declarator"}
+
+def _declared_name(declarator: Node) -> Tuple[Optional[Node], Optional[str]]:
+    '''
+    Follows a (possibly nested) declarator down to the identifier it declares,
+    returning that along with the type of the declarator directly wrapping it
+    '''
+    node: Optional[Node] = declarator
+    wrapper = None
+    while node is not None and node.type not in ("identifier", "type_identifier"):
+        if node.type not in _TRANSPARENT_DECLARATORS:
+            wrapper = node.type
+        inner = node.child_by_field_name("declarator")
+        if inner is None: # parenthesized and attributed declarators have no field
+            inner = next(
+                (c for c in node.named_children
+                 if c.type.endswith("declarator") or c.type in ("identifier", "type_identifier")),
+                None
+            )
+        node = inner
+    return node, wrapper
+
+def _declared_symbols(capture: str, node: Node) -> Iterator[Tuple[SymbolType, Node]]:
+    if capture in CAPTURE_TO_STYPE:
+        yield CAPTURE_TO_STYPE[capture], node
         return
-        
-    
-@dataclass
+    # a declaration can declare several names, e.g. `int a, *b;`
+    for declarator in node.children_by_field_name("declarator"):
+        name, wrapper = _declared_name(declarator)
+        if name is None:
+            continue
+        if capture == "typedef":
+            yield SymbolType.TYPEDEF, name
+        else:
+            yield _WRAPPER_TO_STYPE.get(wrapper, SymbolType.EXTERNDEF), name
+
+# tree-sitter parsers and query cursors aren't thread-safe, so each thread gets
+# its own, made once
+_thread_state = local()
+
+def _parser_and_cursor() -> Tuple[Parser, QueryCursor]:
+    tools = getattr(_thread_state, "tools", None)
+    if tools is None:
+        tools = _thread_state.tools = (Parser(_C_LANGUAGE), QueryCursor(_DECL_QUERY))
+    return tools
+
+def _parse_symbols(
+        text: bytes,
+        type_out: List[Symbol],
+        func_out: List[Symbol],
+        var_out: List[Symbol],
+        old_tree: Optional[Tree] = None
+) -> Tree:
+    '''
+    Appends the symbols declared in `text` to the list for their kind, and
+    returns the tree they were found in. `old_tree`, if given, must already be
+    edited to match `text`, and lets tree-sitter reuse its unchanged subtrees
+    '''
+    parser, cursor = _parser_and_cursor()
+    tree = parser.parse(text, old_tree) if old_tree is not None else parser.parse(text)
+    root = tree.root_node
+    outs = {SymbolType.FUNDEF: func_out, SymbolType.EXTERNDEF: var_out}
+    # matches come back in document order, one capture each
+    for _, captures in cursor.matches(root):
+        for capture, nodes in captures.items():
+            for node in nodes:
+                for stype, name_node in _declared_symbols(capture, node):
+                    # error recovery can insert zero-width MISSING identifiers
+                    if name_node.is_missing or name_node.start_byte == name_node.end_byte:
+                        continue
+                    # the same few identifiers recur across blocks
+                    name = sys.intern(name_node.text.decode("utf8"))
+                    outs.get(stype, type_out).append(Symbol(stype, name))
+    return tree
+
+@dataclass(slots=True, frozen=True)
 class HeaderBlock:
     file: Path
-    flags: List[PreprocessorFlag]
-    text: str
-
-    def parse(self, parser: Parser):
-        cursor = parser.parse(self.text.encode("utf8")).root_node.walk()
-        cursor.goto_first_child()
-        parsed = []
-        while(True):
-            assert cursor.node is not None
-            if cursor.node.type == "type_definition":
-                parsed.append(_parse_type_definition(cursor.node))
-            elif cursor.node.type == "declaration":
-                parsed.append(_parse_declaration(cursor.node))
-            elif cursor.node.type == "struct_specifier":
-                parsed.append(_parse_struct_specifier(cursor.node))
-            elif cursor.node.type == "enum_specifier":
-                parsed.append(_parse_enum_specifier(cursor.node))
-            elif cursor.node.type == ";":
-                pass
-            else:
-                print(f"Unhandled node: {cursor.node.type}")
-            if not (cursor.goto_next_sibling()):
-                break
-        return [p for p in parsed if p is not None]
-    
-    
-def _parse_file_line(line: str) -> Tuple[Path, List[PreprocessorFlag]]:
-    _, _, filepath_quoted, *flags = line.split()
-    parsed_flags = [PreprocessorFlag(int(f)) for f in flags]
-    return (Path(filepath_quoted[1:-1]), parsed_flags)
+    flags: int # a union of PreprocessorFlag bits
+    text: bytes
+
+
+# greedy, so a path containing quotes still runs to the last one on the line
+_FILE_LINE_RE = re.compile(rb'# \d+ "(.*)"((?: [1-4])*)')
+
+def _parse_file_line(line: bytes) -> Optional[Tuple[Path, int]]:
+    '''
+    `None` for directives which aren't line markers, e.g. a `#pragma`
+    '''
+    m = _FILE_LINE_RE.match(line)
+    if m is None:
+        return None
+    parsed_flags = 0
+    for f in m.group(2).split():
+        parsed_flags |= 1 << (int(f) - 1)
+    return (Path(os.fsdecode(m.group(1))), parsed_flags)
     
-def _parse_blocks(header_text: str) -> Generator[HeaderBlock]:
+def _parse_blocks(header_lines: Iterable[bytes]) -> Generator[HeaderBlock]:
     '''
     (https://gcc.gnu.org/onlinedocs/cpp/Preprocessor-Output.html)
     Preprocessor output delimits which files things come from using the following form:
@@ -146,49 +188,237 @@ def _parse_blocks(header_text: str) -> Generator[HeaderBlock]:
     3 - Text comes from a system header file
     4 - The following text should be treated as being wrapped in an extern "C" block
     '''
-    lines = header_text.split("\n")
-    curr_block_text = []
+    def _block(header, text: bytearray) -> HeaderBlock:
+        # blank lines are kept, but a block of nothing else is empty
+        return HeaderBlock(*header, b"" if text.isspace() else bytes(text))
+
+    curr_block_text = bytearray()
     curr_header = None
-    for line in lines:
-        if line.startswith("#"):
-            if curr_header is None:
-                curr_header = _parse_file_line(line)
-            else:
-                block = HeaderBlock(*curr_header, "\n".join(curr_block_text))
-                yield block
-                curr_header = _parse_file_line(line)
-                curr_block_text = []
+    for line in header_lines:
+        file_line = _parse_file_line(line) if line.startswith(b"#") else None
+        if file_line is not None:
+            if curr_header is not None:
+                yield _block(curr_header, curr_block_text)
+                curr_block_text.clear()
+            curr_header = file_line
         else:
-            if not (line.isspace() or len(line) == 0):
-                curr_block_text.append(line)
-    yield HeaderBlock(*curr_header, "\n".join(curr_block_text))
+            curr_block_text += line
+    yield _block(curr_header, curr_block_text)
+
+
+# Bump whenever the layout of cache entries changes
+_CACHE_VERSION = "5"
+
+def _cache_root() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "spack-abi" / "parse-cache"
+
+def _cache_key(header_file: Path) -> Optional[str]:
+    '''
+    Hash of everything that determines the preprocessed output, apart from the
+    included files, which are instead validated against their stat on load
+    '''
+    gcc = which("gcc")
+    if gcc is None:
+        return None
+    gcc_stat = os.stat(gcc)
+    h = hashlib.sha256()
+    h.update(f"{header_file.absolute()}\0{gcc}\0{gcc_stat.st_mtime_ns}\0{gcc_stat.st_size}\0".encode())
+    h.update(header_file.read_bytes())
+    return h.hexdigest()
+
+DepStats = List[Tuple[str, int, int]]
+
+def _file_stats(files: Iterable[str]) -> DepStats:
+    stats = []
+    for f in files:
+        st = os.stat(f)
+        stats.append((f, st.st_mtime_ns, st.st_size))
+    return stats
+
+def _deps_unchanged(deps: DepStats) -> bool:
+    try:
+        return _file_stats(f for f, _, _ in deps) == deps
+    except OSError:
+        return False
+
+def _symbols_from_cache(
+        key: str
+) -> Optional[Tuple[DepStats, Tuple[List[Symbol], List[Symbol], List[Symbol]]]]:
+    root = _cache_root()
+    try:
+        if (root / "version").read_text() != _CACHE_VERSION:
+            return None
+        with open(root / key[:2] / f"{key[2:]}.pkl", "rb") as f:
+            deps, symbols = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    if not _deps_unchanged(deps):
+        return None
+    types, funcs, vars = (
+        [Symbol(SymbolType(stype), sym) for stype, sym in syms] for syms in symbols
+    )
+    return deps, (types, funcs, vars)
+
+def _symbols_to_cache(
+        key: str,
+        deps: DepStats,
+        symbols: Tuple[List[Symbol], List[Symbol], List[Symbol]]
+):
+    root = _cache_root()
+    try:
+        version_file = root / "version"
+        if not version_file.exists() or version_file.read_text() != _CACHE_VERSION:
+            rmtree(root, ignore_errors=True)
+            root.mkdir(parents=True)
+            version_file.write_text(_CACHE_VERSION)
+        entry = root / key[:2] / f"{key[2:]}.pkl"
+        entry.parent.mkdir(exist_ok=True)
+        # Symbols are stored as plain tuples, which unpickle faster than dataclasses
+        payload = (
+            deps,
+            tuple([(s.stype.value, s.symbol) for s in syms] for syms in symbols)
+        )
+        with NamedTemporaryFile(dir=entry.parent, delete=False) as tf:
+            pickle.dump(payload, tf, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tf.name, entry)
+    except OSError:
+        pass # the cache is only an optimization
 
-   
 def parse_header(
-        header_file: Path
+        header_file: Path,
+        use_cache: bool = True
 ) -> Tuple[List [Symbol], List [Symbol], List [Symbol]]:
+    '''
+    Returns the (types, functions, variables) declared by `header_file` and
+    the non-system headers it includes. Results are cached on disk, keyed on
+    the header's contents and the `gcc` used to preprocess it, and are reused
+    as long as none of the files that went into the preprocessed output change.
+    Within a process they are also memoized on the header's path, under the
+    same check. `use_cache=False` bypasses both.
+    '''
+    if not use_cache:
+        _, symbols = _parse_header(header_file, use_cache=False)
+        return symbols
+    memo_key = str(header_file.absolute())
+    memo = _HEADER_MEMO.pop(memo_key, None)
+    if memo is None or not _deps_unchanged(memo[0]):
+        memo = _parse_header(header_file, use_cache=True)
+    if memo[0] is not None:
+        if len(_HEADER_MEMO) >= _HEADER_MEMO_SIZE:
+            del _HEADER_MEMO[next(iter(_HEADER_MEMO))]
+        _HEADER_MEMO[memo_key] = memo
+    types, funcs, vars = memo[1]
+    # copies, so callers can't modify the memoized result
+    return list(types), list(funcs), list(vars)
+
+# The (stat of every file in the preprocessed output, symbols) of each parsed header
+_HEADER_MEMO: Dict[str, Tuple[DepStats, Tuple[List[Symbol], List[Symbol], List[Symbol]]]] = {}
+_HEADER_MEMO_SIZE = 64
+
+# The last parsed text and tree of each header, so that a re-parse after a small
+# edit (i.e. in a long-running process) only redoes the part that changed
+_TREE_CACHE: Dict[str, Tuple[bytes, Tree]] = {}
+_TREE_CACHE_SIZE = 64
+
+def _common_prefix_len(a: bytes, b: bytes, limit: int) -> int:
+    step = 1 << 16
+    i = 0
+    while i < limit and a[i:i + step] == b[i:i + step]:
+        i += step
+    i = min(i, limit)
+    while i < limit and a[i] == b[i]:
+        i += 1
+    return i
+
+def _common_suffix_len(a: bytes, b: bytes, limit: int) -> int:
+    step = 1 << 16
+    i = 0
+    while i < limit:
+        n = min(step, limit - i)
+        if a[len(a) - i - n:len(a) - i] != b[len(b) - i - n:len(b) - i]:
+            break
+        i += n
+    while i < limit and a[len(a) - i - 1] == b[len(b) - i - 1]:
+        i += 1
+    return i
+
+def _point(text: bytes, offset: int) -> Tuple[int, int]:
+    row = text.count(b"\n", 0, offset)
+    return (row, offset - (text.rfind(b"\n", 0, offset) + 1))
+
+def _edited_tree(old_text: bytes, old_tree: Tree, text: bytes) -> Tree:
+    '''
+    Describes the change from `old_text` to `text` to `old_tree` as a single
+    edit spanning everything between their common prefix and suffix
+    '''
+    limit = min(len(old_text), len(text))
+    start = _common_prefix_len(old_text, text, limit)
+    suffix = _common_suffix_len(old_text, text, limit - start)
+    old_end = len(old_text) - suffix
+    new_end = len(text) - suffix
+    old_tree.edit(
+        start_byte=start,
+        old_end_byte=old_end,
+        new_end_byte=new_end,
+        start_point=_point(text, start),
+        old_end_point=_point(old_text, old_end),
+        new_end_point=_point(text, new_end),
+    )
+    return old_tree
+
+def _parse_header(
+        header_file: Path,
+        use_cache: bool
+) -> Tuple[Optional[DepStats], Tuple[List [Symbol], List [Symbol], List [Symbol]]]:
+    '''
+    Also returns the stat of every file that went into the preprocessed output,
+    `None` when it couldn't be taken or `use_cache` is unset
+    '''
+    key = _cache_key(header_file) if use_cache else None
+    if key is not None:
+        cached = _symbols_from_cache(key)
+        if cached is not None:
+            return cached
     type_symbols = []
     var_symbols = []
     func_symbols = []
-    def _separate_symbols(syms):
-        for sym in syms:
-            match sym.stype:
-                case SymbolType.FUNDEF:
-                    func_symbols.append(sym)
-                case SymbolType.EXTERNDEF:
-                    var_symbols.append(sym)
-                case _:
-                    type_symbols.append(sym)
-        
-    header_text = run_preproc(header_file)
-    blocks = [
-        b for b in _parse_blocks(header_text)
-        if len(b.text) > 0 and PreprocessorFlag.SYSTEM_FILE not in b.flags 
-    ]
-    C_LANGUAGE = Language(tsc.language())
-    parser = Parser(C_LANGUAGE)
-    for b in blocks:
-        _separate_symbols(b.parse(parser))
-    return type_symbols, func_symbols, var_symbols 
+    block_files = set()
+    def _blocks_to_parse() -> Iterator[HeaderBlock]:
+        for b in _parse_blocks(run_preproc(header_file)):
+            block_files.add(b.file)
+            if len(b.text) != 0 and not b.flags & _SYSTEM_FILE:
+                yield b
+
+    # The kept blocks are parsed as one translation unit: a single parse and
+    # query pass rather than one per block. System headers are already
+    # filtered out, so what is held in memory is only the header's own text
+    text = bytearray()
+    for b in _blocks_to_parse():
+        text += b.text
+        text += b"\n"
+    text = bytes(text)
+    tree_key = str(header_file.absolute())
+    # popped, so a tree is only ever edited and reused by one caller
+    previous = _TREE_CACHE.pop(tree_key, None) if use_cache else None
+    old_tree = _edited_tree(*previous, text) if previous is not None else None
+    tree = _parse_symbols(text, type_symbols, func_symbols, var_symbols, old_tree)
+    if use_cache:
+        if len(_TREE_CACHE) >= _TREE_CACHE_SIZE:
+            del _TREE_CACHE[next(iter(_TREE_CACHE))]
+        _TREE_CACHE[tree_key] = (text, tree)
+    symbols = (type_symbols, func_symbols, var_symbols)
+    if not use_cache:
+        return None, symbols
+    # pseudo-files like <built-in> and <command-line> have no stat
+    deps = {os.path.abspath(f) for f in block_files if not str(f).startswith("<")}
+    deps.add(os.path.abspath(header_file))
+    try:
+        dep_stats = _file_stats(sorted(deps))
+    except OSError:
+        return None, symbols
+    if key is not None:
+        _symbols_to_cache(key, dep_stats, symbols)
+    return dep_stats, symbols
     
     
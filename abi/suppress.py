@@ -4,7 +4,8 @@ from spack.cmd.uninstall import find_matching_specs
 #########
 from argparse import ArgumentParser, REMAINDER
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 #########
 try: # LSP can identify symbols
     from spack.extensions.abi.common import AbiSubcommand, libs_for_spec, headers_for_spec
@@ -15,17 +16,47 @@ except:
     from abi.common import AbiSubcommand, libs_for_spec, headers_for_spec
     from abi.parse_headers import parse_header
 
-def suppression_for_binaries_from_header(binaries: List[Path], header: Path) -> str:
-    abi, _ = ABI.from_binaries(binaries)
-    header_types, header_functions, header_vars = parse_header(header)
-    header_type_symbols = [ht.symbol for ht in header_types]
-    header_function_symbols = [hf.symbol for hf in header_functions]
-    private_types = [cd for cd in abi.class_decls if cd.name not in header_type_symbols]
-    private_types += [td for td in abi.typedef_decls if td.name not in header_type_symbols]
-    private_funcs = [fd for fd in abi.fun_decls if fd.name not in header_function_symbols]
-    type_suppressions = [t.to_suppression(abi.path) for t in private_types]
-    func_suppressions = [f.to_suppression(abi.path) for f in private_funcs]
-    return "\n".join(type_suppressions + func_suppressions)
+def suppression_for_binaries_from_header(
+        binaries: List[Path],
+        header: Path,
+        use_cache: bool = True
+) -> bytes:
+    # abidw and gcc/tree-sitter are independent, so both run at once. The header
+    # is parsed on the calling thread, which keeps its thread-local parser
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        abi_future = executor.submit(ABI.from_binaries_stream, binaries)
+        header_types, header_functions, header_vars = parse_header(header, use_cache=use_cache)
+        abi = abi_future.result()
+    header_type_symbols = {ht.symbol for ht in header_types}
+    header_function_symbols = {hf.symbol for hf in header_functions}
+    suppressions = []
+    for cd in abi.class_decls:
+        if cd.name not in header_type_symbols:
+            suppressions.append(cd.to_suppression(abi.path))
+    for td in abi.typedef_decls:
+        if td.name not in header_type_symbols:
+            suppressions.append(td.to_suppression(abi.path))
+    for fd in abi.fun_decls:
+        if fd.name not in header_function_symbols:
+            suppressions.append(fd.to_suppression(abi.path))
+    return "\n".join(suppressions).encode("utf8")
+
+def _resolve_inputs(args) -> Tuple[List[Path], Path]:
+    '''
+    The binaries and header to generate suppressions from. An explicit shared
+    object is used directly, without going through Spack's database
+    '''
+    assert len(args.target) > 0, "Expected a spec or shared object file"
+    target = args.target[0]
+    if target.endswith(".so") or ".so." in Path(target).name:
+        assert args.header_path is not None, "Explicit binary requires explicit path to header"
+        return [Path(target)], Path(args.header_path)
+    installed_spec = find_matching_specs(env=None, specs=parse_specs(args.target))[0]
+    binaries = libs_for_spec(installed_spec)
+    if args.header_path is not None:
+        return binaries, Path(args.header_path)
+    header = [h for h in headers_for_spec(installed_spec) if h.name == args.header_name][0]
+    return binaries, header
 
 
 class SuppressCmd(AbiSubcommand):
@@ -47,6 +78,11 @@ class SuppressCmd(AbiSubcommand):
             type=str,
             help="The path to the header file used for public interface"
         )
+        subparser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Re-parse the header rather than reusing cached results"
+        )
         subparser.add_argument(
             "target",
             type=str,
@@ -57,24 +93,17 @@ class SuppressCmd(AbiSubcommand):
 
     @classmethod
     def cmd(cls, args):
-        if args.target.ends_with(".so"):
-            binaries = [Path(args.target)]
-            assert args.header_path is not None, "Explicit binary requires explicit path to header"
-            header = Path(args.header_path)
-        else:
-            installed_spec = find_matching_specs(env=None, specs=parse_specs(args.spec))[0]
-            binaries = libs_for_spec(installed_spec)
-            assert args.header_name is not None, "Explicit spec requires name of header file"
-            header = [
-                Path(h) for h in headers_for_spec(installed_spec)
-                if Path(h).name == args.header_name
-            ][0]
-        suppression_text = suppression_for_binaries_from_header(binaries, header)
+        binaries, header = _resolve_inputs(args)
+        suppression_text = suppression_for_binaries_from_header(
+            binaries, header, use_cache=not args.no_cache
+        )
         if args.output_file:
-            with open(args.output_file, "w") as f:
+            with open(args.output_file, "wb") as f:
                 f.write(suppression_text)
         else:
-            print(suppression_text)
+            # through `sys.stdout` itself, which Spack may have replaced to
+            # capture output, and in order with anything printed before
+            print(suppression_text.decode("utf8"))
     
 
     @classmethod
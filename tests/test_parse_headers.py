@@ -0,0 +1,100 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from abi.parse_headers import SymbolType, _parse_symbols, parse_header
+
+
+def _symbols(text: bytes):
+    types, funcs, vars = [], [], []
+    _parse_symbols(text, types, funcs, vars)
+    return (
+        [(s.stype, s.symbol) for s in types],
+        [(s.stype, s.symbol) for s in funcs],
+        [(s.stype, s.symbol) for s in vars],
+    )
+
+
+def test_typedef_shapes():
+    types, _, _ = _symbols(
+        b"typedef int fn(int);\n"
+        b"typedef int (fnp_t)(int);\n"
+        b"typedef char *(*strfn_t)(void);\n"
+        b"typedef void (*cb_t)(int);\n"
+        b"typedef char **strv_t;\n"
+        b"typedef int arr_t[4];\n"
+    )
+    assert types == [
+        (SymbolType.TYPEDEF, name)
+        for name in ["fn", "fnp_t", "strfn_t", "cb_t", "strv_t", "arr_t"]
+    ]
+
+
+def test_function_shapes():
+    _, funcs, _ = _symbols(
+        b"extern int ( png_sig_cmp) (const char *p, int n);\n"
+        b"char *name(void);\n"
+        b"char **names(void);\n"
+        b"extern void fail(void) __attribute__((noreturn));\n"
+    )
+    assert funcs == [
+        (SymbolType.FUNDEF, name) for name in ["png_sig_cmp", "name", "names", "fail"]
+    ]
+
+
+def test_variable_shapes():
+    types, funcs, vars = _symbols(
+        b"extern int m[2][3];\n"
+        b"const char *const names[];\n"
+        b"extern int (*handlers[4])(int);\n"
+        b"char **(*getv)(void);\n"
+        b"void (*hook)(int);\n"
+        b"int x = 1, *y = 0;\n"
+    )
+    assert funcs == []
+    assert vars == [
+        (SymbolType.EXTERNDEF, name) for name in ["m", "names", "handlers", "x"]
+    ]
+    assert types == [
+        (SymbolType.PTRDEF, name) for name in ["getv", "hook", "y"]
+    ]
+
+
+def test_struct_and_enum():
+    types, _, _ = _symbols(b"struct s { int a; };\nenum e { A };\nenum { B };\n")
+    assert types == [(SymbolType.STRUCTDEF, "s"), (SymbolType.ENUMDEF, "e")]
+
+
+def test_missing_identifiers_are_skipped():
+    # error recovery inserts a zero-width identifier for the missing return type
+    types, funcs, vars = _symbols(b"extern\n\n is_linetouched (WINDOW *,int);\n")
+    assert all(name for _, name in types + funcs + vars)
+
+
+def test_non_ascii_identifiers():
+    types, funcs, _ = _symbols("int café(int);\ntypedef int λ_t;\n".encode("utf8"))
+    assert types == [(SymbolType.TYPEDEF, "λ_t")]
+    assert funcs == [(SymbolType.FUNDEF, "café")]
+
+
+def test_repeated_include_fragments_are_kept(tmp_path):
+    # f.h contributes an identical block inside both structs; each `};` that
+    # follows it must survive for the rest of the header to parse
+    (tmp_path / "f.h").write_text("int f_x;\n")
+    (tmp_path / "g.h").write_text("int g_fn(void);\n")
+    (tmp_path / "hh.h").write_text("int h_fn(void);\n")
+    header = tmp_path / "dd.h"
+    header.write_text(
+        "struct a {\n"
+        "#include \"f.h\"\n"
+        "};\n"
+        "#include \"g.h\"\n"
+        "struct b {\n"
+        "#include \"f.h\"\n"
+        "};\n"
+        "#include \"hh.h\"\n"
+        "int tail_fn(void);\n"
+    )
+    types, funcs, _ = parse_header(header, use_cache=False)
+    assert [s.symbol for s in types] == ["a", "b"]
+    assert [s.symbol for s in funcs] == ["g_fn", "h_fn", "tail_fn"]